@@ -1,17 +1,95 @@
 
 
+import io
+
 import streamlit as st
+import numpy as np
 import pandas as pd
 
-
-def guess_column(columns, search_string):
+try:
+    import polars as pl
+except ImportError:
+    pl = None
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+if njit is not None:
+    @njit(parallel=True, cache=True)
+    def adjust_breakdown(codes, imps, needs_fix, pct, n_groups):
+        # Find the first row with the most impressions in each group in one pass
+        top = np.full(n_groups, -1, dtype=np.int64)
+        for i in range(len(codes)):
+            g = codes[i]
+            if g >= 0 and (top[g] < 0 or imps[i] > imps[top[g]]):
+                top[g] = i
+
+        # Give the whole breakdown to that row wherever the group needs fixing, updating pct in place
+        for i in prange(len(codes)):
+            g = codes[i]
+            if g >= 0 and needs_fix[i]:
+                pct[i] = 1.0 if top[g] == i else 0.0
+
+
+@st.cache_data(show_spinner='Parsing CSV...', max_entries=2)
+def load_csv(_file_bytes, file_id):
+    # Read CSV with the multi-threaded Arrow parser, falling back to the C engine on older pandas.
+    # Keyed on the upload's file_id so the bytes aren't hashed on every rerun.
+    try:
+        return pd.read_csv(io.BytesIO(_file_bytes), engine='pyarrow', dtype_backend='pyarrow')
+    except (ImportError, TypeError, ValueError):
+        return pd.read_csv(io.BytesIO(_file_bytes))
+
+
+@st.cache_data(max_entries=2)
+def encode_csv(_df, result_key):
+    # Write straight to bytes so reruns reuse the encoded output; result_key identifies the frame
+    buf = io.BytesIO()
+    _df.to_csv(buf, index=False)
+    return buf.getvalue()
+
+
+@st.cache_data(max_entries=2)
+def encode_parquet(_df, result_key):
+    buf = io.BytesIO()
+    _df.to_parquet(buf, engine='pyarrow', compression='snappy', index=False)
+    return buf.getvalue()
+
+
+def downcast_numeric(df, columns):
+    # Shrink integer columns, NumPy or Arrow-backed, to the smallest dtype that holds their values
     for col in columns:
-        if search_string.lower() in col.lower():
-            return col
-    return None
+        dtype = df[col].dtype
+        if isinstance(dtype, np.dtype) and dtype.kind in 'iu':
+            df[col] = pd.to_numeric(df[col], downcast='unsigned' if (df[col] >= 0).all() else 'integer')
+        elif isinstance(dtype, pd.ArrowDtype) and dtype.kind in 'iu':
+            lo, hi = df[col].min(), df[col].max()
+            if pd.isna(lo):
+                continue
+            candidates = (np.uint8, np.uint16, np.uint32) if lo >= 0 else (np.int8, np.int16, np.int32)
+            for candidate in candidates:
+                info = np.iinfo(candidate)
+                if info.min <= lo and hi <= info.max:
+                    df[col] = df[col].astype(f'{candidate.__name__}[pyarrow]')
+                    break
+    return df
+
+
+def guess_column(lowered, columns, search_string):
+    mask = lowered.str.contains(search_string.lower(), regex=False)
+    return columns[mask][0] if mask.any() else columns[0]
+
+
+@st.cache_data(show_spinner='Processing data...', max_entries=4)
+def process_data(_df, file_id, url_col, device_col, country_col, date_col, clicks_col, impressions_col,
+                 breakdown_columns, include_date, include_totals=False):
+    # The frame is excluded from the cache key (Streamlit only samples large frames); file_id identifies it instead
 
+    # Shrink the metric columns so the groupby transforms walk fewer bytes; done here so it only runs on a cache miss
+    df = downcast_numeric(_df, [clicks_col, impressions_col] + breakdown_columns)
 
-def process_data(df, url_col, device_col, country_col, date_col, clicks_col, impressions_col, breakdown_columns, include_date):
     # Fill nulls in clicks and impressions columns with 0
     df[clicks_col] = df[clicks_col].fillna(0)
     df[impressions_col] = df[impressions_col].fillna(0)
@@ -21,32 +99,109 @@ def process_data(df, url_col, device_col, country_col, date_col, clicks_col, imp
     if include_date:
         groupby_columns.append(date_col)
 
+    # Cast string key columns (object or Arrow-backed) to category so sorting and grouping use integer codes
+    for col in groupby_columns:
+        if pd.api.types.is_string_dtype(df[col]):
+            df[col] = df[col].astype('category')
+
+    # Sort by the keys once so every group is a contiguous slice; stable keeps the original order within groups
+    df = df.sort_values(groupby_columns, kind='stable', ignore_index=True)
+
+    # Build the grouper once and reuse it for every per-page calculation
+    gb = df.groupby(groupby_columns, sort=False, observed=True)
+
     # Calculate total_clicks_by_page
-    df['total_clicks_by_page'] = df.groupby(groupby_columns)[clicks_col].transform('sum')
+    total_clicks = gb[clicks_col].transform('sum')
+    df['total_clicks_by_page'] = total_clicks
+
+    # Calculate percentage_breakdown based on clicks straight into one output buffer,
+    # leaving 0 where the page has no clicks
+    total = total_clicks.to_numpy(dtype=np.float64, na_value=np.nan)
+    clicks = df[clicks_col].to_numpy(dtype=np.float64, na_value=np.nan)
+    has_clicks = total > 0
+    pct = np.empty_like(total)
+    np.divide(clicks, total, out=pct, where=has_clicks)
+    pct[~has_clicks] = 0.0
+
+    # Calculate total_x_per_page for the breakdown metrics only when they're wanted in the output
+    breakdown_totals = None
+    if include_totals:
+        breakdown_totals = gb[breakdown_columns].transform('sum')
+        df[[f'total_{col}_per_page' for col in breakdown_columns]] = breakdown_totals
+
+    # Adjust percentage_breakdown where there are no clicks but other metrics > 0,
+    # giving the whole breakdown to the first row with the most impressions.
+    # Updates go into the pct array and are written to the frame once.
+    # Skipped entirely when every group has clicks, which is the common case.
+    needs_fix = total == 0
+    if needs_fix.any():
+        if breakdown_totals is None:
+            breakdown_totals = gb[breakdown_columns].transform('sum')
+        needs_fix &= (breakdown_totals.to_numpy(dtype=np.float64, na_value=np.nan) > 0).any(axis=1)
+        imps = df[impressions_col].to_numpy(dtype=np.float64, na_value=np.nan)
+        # Rows with a missing key get NaN from ngroup; use -1 so they stay integer codes the kernel skips
+        codes = gb.ngroup().fillna(-1).to_numpy(dtype=np.int64)
+
+        if njit is not None:
+            adjust_breakdown(codes, imps, needs_fix, pct, gb.ngroups)
+        else:
+            grp_max = gb[impressions_col].transform('max').to_numpy(dtype=np.float64, na_value=np.nan)
+            candidates = np.flatnonzero(imps == grp_max)
+            _, first = np.unique(codes[candidates], return_index=True)
+            is_top = np.zeros(len(df), dtype=bool)
+            is_top[candidates[first]] = True
+            pct[needs_fix] = is_top[needs_fix]
+    df['percentage_breakdown'] = pct
+
+    # Estimate every breakdown metric once, in a single broadcast multiplication
+    estimated_columns = [f'{col}_estimated' for col in breakdown_columns]
+    vals = df[breakdown_columns].to_numpy(dtype=np.float64, na_value=np.nan)
+    df[estimated_columns] = vals * pct[:, None]
 
-    # Calculate percentage_breakdown based on clicks
-    df['percentage_breakdown'] = df.apply(
-        lambda row: row[clicks_col] / row['total_clicks_by_page'] if row['total_clicks_by_page'] > 0 else 0,
-        axis=1
-    )
+    return df
+
+
+@st.cache_data(show_spinner='Processing data...', max_entries=4)
+def process_data_polars(_df, file_id, url_col, device_col, country_col, date_col, clicks_col, impressions_col,
+                        breakdown_columns, include_date, include_totals=False):
+    # Same calculation as process_data, expressed as a single lazy Polars pipeline, cached on file_id the same way
+    df = downcast_numeric(_df, [clicks_col, impressions_col] + breakdown_columns)
+    groupby_columns = [url_col, country_col, device_col]
+    if include_date:
+        groupby_columns.append(date_col)
 
-    # Calculate total_x_per_page for each breakdown metric
-    for col in breakdown_columns:
-        total_col_name = f'total_{col}_per_page'
-        df[total_col_name] = df.groupby(groupby_columns)[col].transform('sum')
-        df[f'{col}_estimated'] = df['percentage_breakdown'] * df[col]
+    # Sort by the keys like process_data does; stable keeps the original order within groups
+    lf = pl.from_pandas(df).lazy().sort(groupby_columns, nulls_last=True, maintain_order=True).with_columns(
+        pl.col(clicks_col).fill_null(0),
+        pl.col(impressions_col).fill_null(0),
+    )
 
-    # Add a row_number column based on impressions within each group
-    df['row_number'] = df.groupby(groupby_columns)[impressions_col].rank(method='first', ascending=False)
+    # Per-page click totals, left null for rows with a missing key as pandas' groupby drops them
+    has_keys = pl.all_horizontal([pl.col(col).is_not_null() for col in groupby_columns])
+    lf = lf.with_columns(
+        pl.when(has_keys).then(pl.col(clicks_col).sum().over(groupby_columns)).alias('total_clicks_by_page')
+    )
+    if include_totals:
+        lf = lf.with_columns(
+            [pl.when(has_keys).then(pl.col(col).sum().over(groupby_columns)).alias(f'total_{col}_per_page')
+             for col in breakdown_columns]
+        )
+
+    # Percentage breakdown by clicks, giving the top row by impressions everything
+    # where there are no clicks but other metrics > 0
+    total = pl.col('total_clicks_by_page')
+    pct = pl.when(total > 0).then(pl.col(clicks_col) / total).otherwise(0.0)
+    needs_fix = (total == 0) & pl.any_horizontal([pl.col(col).sum().over(groupby_columns) > 0
+                                                  for col in breakdown_columns])
+    is_top = pl.int_range(pl.len()).over(groupby_columns) == pl.col(impressions_col).arg_max().over(groupby_columns)
+    pct = pl.when(needs_fix).then(is_top.cast(pl.Float64)).otherwise(pct)
+
+    lf = lf.with_columns(pct.alias('percentage_breakdown')).with_columns(
+        [(pl.col('percentage_breakdown') * pl.col(col)).alias(f'{col}_estimated') for col in breakdown_columns]
+    )
 
-    # Adjust percentage_breakdown where there are no clicks but other metrics > 0
-    for _, group in df.groupby(groupby_columns):
-        if group[clicks_col].sum() == 0 and any(group[col].sum() > 0 for col in breakdown_columns):
-            df.loc[group.index, 'percentage_breakdown'] = (group['row_number'] == 1).astype(int)
-            for col in breakdown_columns:
-                df.loc[group.index, f'{col}_estimated'] = df.loc[group.index, 'percentage_breakdown'] * group[col]
+    return lf.collect().to_pandas(use_pyarrow_extension_array=True)
 
-    return df
 
 def main():
     st.title('Breakdown GA4 metrics by query')
@@ -68,8 +223,8 @@ def main():
     uploaded_file = st.file_uploader('Choose a CSV file', type='csv')
 
     if uploaded_file is not None:
-        # Read CSV file
-        df = pd.read_csv(uploaded_file)
+        # Read CSV file, cached per upload so reruns skip the parse
+        df = load_csv(uploaded_file.getvalue(), uploaded_file.file_id)
 
         st.subheader('Uploaded CSV Data')
         st.write(df.head())
@@ -80,27 +235,31 @@ def main():
         The app will attempt to guess the columns based on their names, but you can change the selection if needed.
         """)
 
+        # Lowercase the column names and map them to positions once for guessing
+        lowered = df.columns.str.lower()
+        col_pos = {col: i for i, col in enumerate(df.columns)}
+
         # Get the column names for URL, device, country, date, query, and clicks
         url_col = st.selectbox('Select the column for URL', df.columns,
-                               index=df.columns.tolist().index(guess_column(df.columns, 'url')))
+                               index=col_pos[guess_column(lowered, df.columns, 'url')])
         device_col = st.selectbox('Select the column for Device Category', df.columns,
-                                  index=df.columns.tolist().index(guess_column(df.columns, 'device')))
+                                  index=col_pos[guess_column(lowered, df.columns, 'device')])
         country_col = st.selectbox('Select the column for Country', df.columns,
-                                   index=df.columns.tolist().index(guess_column(df.columns, 'country')))
+                                   index=col_pos[guess_column(lowered, df.columns, 'country')])
 
         query_col = st.selectbox('Select the column for Query', df.columns,
-                                   index=df.columns.tolist().index(guess_column(df.columns, 'query')))
+                                   index=col_pos[guess_column(lowered, df.columns, 'query')])
 
         include_date = st.checkbox('Include Date column', value=True)
         date_col = None
         if include_date:
             date_col = st.selectbox('Select the column for Date', df.columns,
-                                    index=df.columns.tolist().index(guess_column(df.columns, 'date')))
+                                    index=col_pos[guess_column(lowered, df.columns, 'date')])
 
         clicks_col = st.selectbox('Select the column for Clicks', df.columns,
-                                  index=df.columns.tolist().index(guess_column(df.columns, 'clicks')))
+                                  index=col_pos[guess_column(lowered, df.columns, 'clicks')])
         impressions_col = st.selectbox('Select the column for Impressions', df.columns,
-                                  index=df.columns.tolist().index(guess_column(df.columns, 'impressions')))
+                                  index=col_pos[guess_column(lowered, df.columns, 'impressions')])
 
         st.markdown("""
         ### Breakdown Columns
@@ -115,38 +274,57 @@ def main():
         # Get the list of columns for breakdown by query
         breakdown_columns = st.multiselect('Select columns for breakdown by query', breakdown_options)
 
-        if breakdown_columns:
-            # Process the data
-            processed_df = process_data(df, url_col, device_col, country_col, date_col, clicks_col,impressions_col,
-                                        breakdown_columns, include_date)
+        # Polars engine is only offered when polars is installed
+        use_polars = pl is not None and st.checkbox('Use Polars engine', value=False)
 
+        if breakdown_columns:
             # Checkbox to decide grouping without date
             group_without_date = st.checkbox('Group data by summing metrics and exclude date', value=True)
 
+            # Per-page totals of each breakdown metric are left out of the output unless asked for;
+            # grouping drops them, so the option is only offered on the ungrouped output
+            include_totals = not group_without_date and st.checkbox('Show per-page totals', value=False)
+
+            # Process the data
+            process = process_data_polars if use_polars else process_data
+            processed_df = process(df, uploaded_file.file_id, url_col, device_col, country_col, date_col, clicks_col,
+                                   impressions_col, breakdown_columns, include_date, include_totals)
+
             # Conditional grouping based on checkbox
             if group_without_date:
                 # Define grouping columns excluding the date column
                 group_columns = [url_col, country_col, device_col, query_col]  # Only dimension columns for grouping
 
-                # Sum the metrics without grouping by them
-                aggregation_functions = {clicks_col: 'sum'}  # Ensure clicks are summed
-                for col in breakdown_columns:
-                    aggregation_functions[f'{col}_estimated'] = 'sum'  # Sum estimated columns
+                # Sum the clicks and estimated metrics without grouping by them
+                value_cols = [clicks_col] + [f'{col}_estimated' for col in breakdown_columns]
 
-                # Group by the defined columns and apply aggregation functions
-                processed_df = processed_df.groupby(group_columns).agg(aggregation_functions).reset_index()
+                # Group by the defined columns and sum with the groupby-sum kernel
+                processed_df = processed_df.groupby(group_columns, sort=False, observed=True,
+                                                    as_index=False)[value_cols].sum()
 
             st.subheader('Processed Data')
             st.write(processed_df.head())
 
-            # Download the processed data as CSV
-            csv = processed_df.to_csv(index=False)
-            st.download_button(
-                label='Download processed data as CSV',
-                data=csv,
-                file_name='processed_data.csv',
-                mime='text/csv'
-            )
+            # Everything that determines processed_df, used to key the encoded downloads
+            result_key = (uploaded_file.file_id, use_polars, url_col, device_col, country_col, date_col, query_col, clicks_col,
+                          impressions_col, tuple(breakdown_columns), include_date, include_totals, group_without_date)
+
+            # Only the chosen format is encoded; Parquet is smaller and faster to load for large outputs
+            download_format = st.radio('Download format', ['CSV', 'Parquet'], horizontal=True)
+            if download_format == 'CSV':
+                st.download_button(
+                    label='Download processed data as CSV',
+                    data=encode_csv(processed_df, result_key),
+                    file_name='processed_data.csv',
+                    mime='text/csv'
+                )
+            else:
+                st.download_button(
+                    label='Download processed data as Parquet',
+                    data=encode_parquet(processed_df, result_key),
+                    file_name='processed_data.parquet',
+                    mime='application/octet-stream'
+                )
 
 
 if __name__ == '__main__':